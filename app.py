@@ -2,26 +2,55 @@ import base64  # for encoding the script for variable
 
 import os
 import re
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 import build
-import json
-from flask import Flask, flash, render_template, request, redirect, url_for, send_from_directory
-from werkzeug import secure_filename
+from flask import Flask, Request, flash, render_template, request, redirect, session, url_for, send_from_directory
+from werkzeug.utils import secure_filename
 import requests
 
 
 # These are the extension that we are accepting to be uploaded
-ALLOWED_EXTENSIONS_WALLPAPERS = set(['png', 'jpg', 'jpeg'])
-ALLOWED_EXTENSIONS_LOGO = set(['svg'])
-ALLOWED_EXTENSIONS_ZIP = set(['gz','zip'])
+ALLOWED_EXTENSIONS_WALLPAPERS = frozenset({'png', 'jpg', 'jpeg'})
+ALLOWED_EXTENSIONS_LOGO = frozenset({'svg'})
+ALLOWED_EXTENSIONS_ZIP = frozenset({'gz', 'zip'})
+
+# Patterns used by urlify(), compiled once at import
+NON_WORD_RE = re.compile(r"[^\w\s]")
+WHITESPACE_RE = re.compile(r"\s+")
 
 #The name of the upload directories
 UPLOAD_FOLDER = 'uploads/'
 WALLPAPER_FOLDER  = 'wallpapers/'
 LOGO_FOLDER = 'logos/'
 ZIP_FOLDER = 'zip-archives/'
+WALLPAPER_DIR = os.path.join(UPLOAD_FOLDER, WALLPAPER_FOLDER)
+LOGO_DIR = os.path.join(UPLOAD_FOLDER, LOGO_FOLDER)
+ZIP_DIR = os.path.join(UPLOAD_FOLDER, ZIP_FOLDER)
+
+# The build script sent to Travis, base64-encoded once at startup
+with open('travis_script_1.sh', 'rb') as f:
+    TRAVIS_SCRIPT = base64.b64encode(f.read()).decode('ascii')
+
+# Seconds to wait for transfer.sh / 0x0.st to (connect, answer) before falling back
+UPLOAD_TIMEOUT = (5, 30)
+
+# Copy uploads to disk in 1 MiB chunks instead of Werkzeug's default 16 KiB
+SAVE_BUFFER_SIZE = 1024 * 1024
+
+# Each uploaded file is kept in memory up to this size, larger ones spill to
+# disk; with 8 threads and 3 files per request that is at most 24 MiB a worker
+UPLOAD_MEMORY_SIZE = 1024 * 1024
+
+class UploadRequest(Request):
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        # Same as Werkzeug's default stream but with the per-file in-memory
+        # limit raised from 500 KB to UPLOAD_MEMORY_SIZE
+        return tempfile.SpooledTemporaryFile(max_size=UPLOAD_MEMORY_SIZE)
 
 # Initialize the Flask application
 app = Flask(__name__)
+app.request_class = UploadRequest
 
 # Initializing flask secret key using the environment variable "secret_key"
 app.secret_key = os.environ.get('secret_key', 'z528&^FJjhd_t2bxc#$2').encode()
@@ -34,18 +63,35 @@ app.config['WALLPAPER_FOLDER'] = WALLPAPER_FOLDER
 
 # The maximum file size
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024
-flag = True
+
+# Let a fronting web server that honours X-Sendfile (apache with mod_xsendfile,
+# lighttpd) send uploaded files instead of streaming them through the worker,
+# when "USE_X_SENDFILE" is set; without such a server downloads come back empty
+app.config['USE_X_SENDFILE'] = os.environ.get('USE_X_SENDFILE', '').lower() in ('1', 'true')
 
 def allowed_file(filename,allowed_extension):
-    return '.' in filename and \
-           filename.rsplit('.', 1)[1] in allowed_extension
+    # Compare case-insensitively so that e.g. "photo.JPG" is accepted
+    return os.path.splitext(filename)[1][1:].lower() in allowed_extension
 
 def urlify(s):
     """Remove all non-word characters (everything except numbers and letters)"""
-    s = re.sub(r"[^\w\s]", '', s).strip()
+    s = NON_WORD_RE.sub('', s).strip()
     # Replace all runs of whitespace with a single dash
-    s = re.sub(r"\s+", '-', s)
-    return s
+    return WHITESPACE_RE.sub('-', s)
+
+def save_upload(upload, directory, name):
+    """Save an upload as directory/name, replacing any previous file"""
+    # Write to a unique temporary file first so that concurrent uploads never
+    # share a half-written file and the final name is swapped in atomically
+    fd, tmp = tempfile.mkstemp(prefix=name + '.', dir=directory)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            os.fchmod(f.fileno(), 0o644)
+            upload.save(f, buffer_size=SAVE_BUFFER_SIZE)
+        os.replace(tmp, os.path.join(directory, name))
+    except:
+        os.remove(tmp)
+        raise
 
 def upload_wallpaper(wallpaper):
     url=""
@@ -54,26 +100,23 @@ def upload_wallpaper(wallpaper):
             filename = secure_filename(wallpaper.filename)
             try:
                 # Uploading wallpaper to transfer.sh
-                response = requests.post('https://transfer.sh', files= {'file': (filename, wallpaper),})
+                response = build.SESSION.post('https://transfer.sh', files= {'file': (filename, wallpaper),}, timeout=UPLOAD_TIMEOUT)
                 url = response.text
             except:
                 try:
                     print("upload failed(transfer.sh) \n retrying(0x0.st)")
                     wallpaper.seek(0)
-                    response = requests.post('https://0x0.st', files= {'file': (filename, wallpaper),})
+                    response = build.SESSION.post('https://0x0.st', files= {'file': (filename, wallpaper),}, timeout=UPLOAD_TIMEOUT)
                     url = response.text
                 except:
                     # Saving wallpaper to host
                     wallpaper.seek(0)
-                    wallpaper.save(os.path.join(app.config['UPLOAD_FOLDER'] + app.config['WALLPAPER_FOLDER'], filename))
-                    os.rename(UPLOAD_FOLDER + WALLPAPER_FOLDER + filename, UPLOAD_FOLDER + WALLPAPER_FOLDER + 'wallpaper')
+                    save_upload(wallpaper, WALLPAPER_DIR, 'wallpaper')
                     url = "https://meilix-generator.herokuapp.com/uploads/wallpapers/wallpapers"
             print(url)
         else:
-            flash('Wallpaper not saved, extension not allowed')
-            global flag
-            flag = False
-    return(url)
+            return(url, False)
+    return(url, True)
 
 def upload_logo(logo):
     url=""
@@ -82,37 +125,31 @@ def upload_logo(logo):
             filename = secure_filename(logo.filename)
             try:
                 # Uploading logo to transfer.sh
-                response = requests.post('https://transfer.sh', files= {'file': (filename, logo),})
+                response = build.SESSION.post('https://transfer.sh', files= {'file': (filename, logo),}, timeout=UPLOAD_TIMEOUT)
                 url = response.text
             except:
                 try:
                     print("upload failed(transfer.sh) \n retrying(0x0.st)")
-                    wallpaper.seek(0)
-                    response = requests.post('https://0x0.st', files= {'file': (filename, logo),})
+                    logo.seek(0)
+                    response = build.SESSION.post('https://0x0.st', files= {'file': (filename, logo),}, timeout=UPLOAD_TIMEOUT)
                     url = response.text
                 except:
                     # Saving logo to host
-                    wallpaper.seek(0)
-                    logo.save(os.path.join(app.config['UPLOAD_FOLDER'] + app.config['LOGO_FOLDER'], filename))
-                    os.rename(UPLOAD_FOLDER + LOGO_FOLDER + filename, UPLOAD_FOLDER + LOGO_FOLDER + 'logo')
+                    logo.seek(0)
+                    save_upload(logo, LOGO_DIR, 'logo')
                     url = "https://meilix-generator.herokuapp.com/uploads/logos/logo"
             print(url)
         else:
-            flash('Logo not saved, extension not allowed')
-            global flag
-            flag = False
-    return(url)
+            return(url, False)
+    return(url, True)
 
 def upload_zip(zipFiles):
     if zipFiles:
         if allowed_file(zipFiles.filename, ALLOWED_EXTENSIONS_ZIP):
-            filename = secure_filename(zipFiles.filename)
-            zipFiles.save(os.path.join(app.config['UPLOAD_FOLDER'] + app.config['ZIP_FOLDER'], filename))
-            os.rename(UPLOAD_FOLDER + ZIP_FOLDER + filename, UPLOAD_FOLDER + ZIP_FOLDER + 'zip-file')
+            save_upload(zipFiles, ZIP_DIR, 'zip-file')
         else:
-            flash('Zip File not saved, extension not allowed')
-            global flag
-            flag = False
+            return False
+    return True
 
 @app.route("/", methods=['GET', 'POST'])
 def index():
@@ -120,70 +157,81 @@ def index():
         email = request.form['email']
         TRAVIS_TAG = request.form['TRAVIS_TAG']
         event_url = request.form['event_url']
+        processor = request.form.get("processor", "amd64") # This will fixe build failure when 32bit is not chosen
+        theme = request.form.get("theme", "light")
         variables = {}
         features = {}
-        processor = "amd64" # This will fixe build failure when 32bit is not chosen
-        theme = "light"
         for name, value in request.form.items():
-            if name == "processor":
-                processor = value
-            if name == "theme":
-                theme = value
             if name.startswith("INSTALL_"):
                 variables[name] = value
-            if name.startswith("SWITCH_ON_"):
+            elif name.startswith("SWITCH_ON_"):
                 features[name] = value
-        recipe = json.dumps(variables, ensure_ascii=False) # Dumping the generator-packages into a JSON array
-        feature = json.dumps(features, ensure_ascii=False) # Dumping the chosen features into a JSON objects
         wallpaper = request.files["desktop-wallpaper"]
-        wallpaper_url = upload_wallpaper(wallpaper)
         logo = request.files["desktop-logo"]
-        logo_url = upload_logo(logo)
         zipFiles = request.files["desktop-files"]
-        upload_zip(zipFiles)
+        # The uploads are independent, so run them side by side
+        with ThreadPoolExecutor(max_workers=3) as executor:
+            wallpaper_job = executor.submit(upload_wallpaper, wallpaper)
+            logo_job = executor.submit(upload_logo, logo)
+            zip_job = executor.submit(upload_zip, zipFiles)
+        wallpaper_url, wallpaper_ok = wallpaper_job.result()
+        logo_url, logo_ok = logo_job.result()
+        zip_ok = zip_job.result()
+        if not wallpaper_ok:
+            flash('Wallpaper not saved, extension not allowed')
+        if not logo_ok:
+            flash('Logo not saved, extension not allowed')
+        if not zip_ok:
+            flash('Zip File not saved, extension not allowed')
         if email != '' and TRAVIS_TAG != '':
-            os.environ["email"] = email
+            # Keep the build parameters in the user's session rather than in
+            # os.environ, which is shared by every request in the process
+            session["email"] = email
             TRAVIS_TAG = urlify(TRAVIS_TAG)  # this will fix url issue
-            os.environ["TRAVIS_TAG"] = TRAVIS_TAG
-            os.environ["event_url"] = event_url
-            os.environ["recipe"] = recipe
-            os.environ["processor"] = processor
-            os.environ["feature"] = feature
-            os.environ["wallpaper_url"] = wallpaper_url
-            os.environ["logo_url"] = logo_url
-            os.environ["theme"] = theme
-            with open('travis_script_1.sh', 'rb') as f:
-                os.environ["TRAVIS_SCRIPT"] = str(base64.b64encode(f.read()))[1:]
+            session["TRAVIS_TAG"] = TRAVIS_TAG
+            session["event_url"] = event_url
+            session["recipe"] = variables
+            session["processor"] = processor
+            session["feature"] = features
+            session["wallpaper_url"] = wallpaper_url
+            session["logo_url"] = logo_url
+            session["theme"] = theme
+            # Only trigger the build if all of the uploads were accepted
+            session["uploads_ok"] = wallpaper_ok and logo_ok and zip_ok
             return redirect(url_for('output'))
     return render_template('index.html')
 
 
 @app.route('/output')
 def output():
-    if flag:
-        if os.environ['TRAVIS_TAG']:  # if TRAVIS_TAG have value it will proceed
-            trigger_code = build.send_trigger_request(os.environ['email'], os.environ['TRAVIS_TAG'], os.environ['event_url'],os.environ['TRAVIS_SCRIPT'], os.environ['recipe'], os.environ['processor'], os.environ['feature'], os.environ['wallpaper_url'], os.environ["logo_url"], os.environ['theme'])
-            if trigger_code != 202:
-                flash('Trigger failed, response code {}'.format(trigger_code)) #Display error if trigger fails
-            return render_template('build.html')
-        else:
-            return redirect(url_for('index'))
-    else:
+    if session.get('TRAVIS_TAG'):  # if TRAVIS_TAG have value it will proceed
+        if session['uploads_ok']:
+            try:
+                trigger_code = build.send_trigger_request(session['email'], session['TRAVIS_TAG'], session['event_url'], TRAVIS_SCRIPT, session['recipe'], session['processor'], session['feature'], session['wallpaper_url'], session["logo_url"], session['theme'])
+            except requests.RequestException as e:
+                # On a timeout Travis may still have accepted the build
+                print('Trigger request failed: {}'.format(e))
+                flash('Could not reach Travis, the build may not have been started')
+            else:
+                if trigger_code != 202:
+                    flash('Trigger failed, response code {}'.format(trigger_code)) #Display error if trigger fails
         return render_template('build.html')
+    else:
+        return redirect(url_for('index'))
 
 # Function to call meilix script on clicking the build button
 
 @app.route('/uploads/wallpapers/<filename>')
 def uploaded_wallpaper(filename):
-    return send_from_directory(app.config['UPLOAD_FOLDER'] + app.config['WALLPAPER_FOLDER'], filename)
+    return send_from_directory(WALLPAPER_DIR, filename)
 
 @app.route('/uploads/logos/<filename>')
 def uploaded_logo(filename):
-    return send_from_directory(app.config['UPLOAD_FOLDER'] + app.config['LOGO_FOLDER'], filename)
+    return send_from_directory(LOGO_DIR, filename)
 
 @app.route('/uploads/zip-archives/<filename>')
 def uploaded_zip(filename):
-    return send_from_directory(app.config['UPLOAD_FOLDER'] + app.config['ZIP_FOLDER'], filename)
+    return send_from_directory(ZIP_DIR, filename)
 
 # Return a custom 404 error.
 @app.errorhandler(404)
@@ -2,35 +2,54 @@
 import json
 import os
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# Seconds to wait on the Travis API before giving up on the trigger
+TRAVIS_TIMEOUT = int(os.environ.get('TRAVIS_TIMEOUT', 10))
+
+def create_session():
+    """Return a requests session that keeps connections open between calls"""
+    session = requests.Session()
+    # Keep one pool per host (transfer.sh, 0x0.st, Travis), each large enough
+    # for every thread of a worker to post at once without dropping sockets.
+    # Uploads are not retried, they already fall back to 0x0.st and the disk
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=64, pool_block=False)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    # Only failed connections to Travis are retried: a POST that reached the
+    # server may already have started a build
+    session.mount('https://api.travis-ci.org/', HTTPAdapter(max_retries=Retry(connect=3, backoff_factor=0.3)))
+    return session
+
+# Shared by the uploads in app.py and the Travis trigger below
+SESSION = create_session()
 
 def send_trigger_request(email, TRAVIS_TAG, event_url, TRAVIS_SCRIPT, recipe, processor, feature, wallpaper_url, logo_url, theme):
     # Params for Travis API
     USER = os.environ.get('USER','fossasia')
     PROJECT = os.environ.get('PROJECT', 'meilix')
     BRANCH = os.environ.get('BRANCH', 'master')
-    softwares = json.dumps(recipe) # This solves `unbound variable`(ISSUE #405)
-    feature = json.dumps(feature)
     travis_api_url = 'https://api.travis-ci.org/repo/{}%2F{}/requests'.format(USER, PROJECT)
-    request_body = {}
-    request = {}
-    request['branch'] = BRANCH
-    request['config'] = {}
-    request['config']['env'] = {}
-    request['config']['env']['email'] = email
-    request['config']['env']['TRAVIS_TAG'] = TRAVIS_TAG
-    request['config']['env']['event_url'] = event_url
-    request['config']['env']['TRAVIS_SCRIPT'] = TRAVIS_SCRIPT
-    request['config']['env']['recipe'] = softwares
-    request['config']['env']['processor'] = processor
-    request['config']['env']['feature'] = feature
-    request['config']['env']['wallpaper_url'] = wallpaper_url
-    request['config']['env']['logo_url'] = logo_url
-    request['config']['env']['theme'] = theme
-    request_body['request'] = request
-    request_body = json.dumps(request_body)
+    env = {
+        'email': email,
+        'TRAVIS_TAG': TRAVIS_TAG,
+        'event_url': event_url,
+        'TRAVIS_SCRIPT': TRAVIS_SCRIPT,
+        # recipe and feature are dicts; they are sent as JSON and quoted once
+        # more, which solves `unbound variable`(ISSUE #405)
+        'recipe': json.dumps(json.dumps(recipe, ensure_ascii=False)),
+        'processor': processor,
+        'feature': json.dumps(json.dumps(feature, ensure_ascii=False)),
+        'wallpaper_url': wallpaper_url,
+        'logo_url': logo_url,
+        'theme': theme,
+    }
+    request_body = json.dumps({'request': {'branch': BRANCH, 'config': {'env': env}}})
     headers = { "Content-Type": "application/json", "Accept": "application/json", "Travis-API-Version": "3", "Authorization": "token {}".format(os.environ.get('KEY', None))}
 
-    response = requests.post(travis_api_url, headers=headers, data=request_body)
+    # Connection attempts are retried, so give each one only a few seconds
+    response = SESSION.post(travis_api_url, headers=headers, data=request_body, timeout=(3, TRAVIS_TIMEOUT))
 
     if response.status_code == 202:
         print('Trigger successful')